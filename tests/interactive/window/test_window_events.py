@@ -1,11 +1,17 @@
 """
 Tests for events on windows.
 """
+import collections
+import functools
+import operator
 import pytest
 import random
 
+from pyglet import app
 from pyglet import font
 from pyglet import gl
+from pyglet import graphics
+from pyglet import text
 from pyglet.window import key, Window
 from pyglet.window.event import WindowEventLogger
 
@@ -13,6 +19,50 @@ from tests.base.interactive import InteractiveTestCase
 from tests.interactive.window import window_util
 
 
+_shared_window = None
+
+
+def _show_shared_window(width, height):
+    """Creating a window and its context is expensive, so all tests in this module share one
+    window that is only hidden in between."""
+    global _shared_window
+    if _shared_window is None:
+        # Without vsync, flip() does not stall event dispatching while waiting for the vblank.
+        _shared_window = Window(width, height, resizable=False, vsync=False)
+        # The clear color is context state, it only has to be set once
+        gl.glClearColor(0.5, 0, 0, 1)
+    else:
+        # Drop events that arrived after the previous test, they belong to that test
+        _shared_window.dispatch_events()
+        if _shared_window.get_size() != (width, height):
+            _shared_window.set_size(width, height)
+        if not _shared_window.visible:
+            _shared_window.set_visible()
+    return _shared_window
+
+
+def _close_shared_window():
+    global _shared_window
+    if _shared_window is not None:
+        _shared_window.close()
+        _shared_window = None
+
+
+@pytest.fixture(autouse=True, scope='class')
+def _shared_window_lifetime(request):
+    """Close the shared window after the last test using it, so it does not stay around while
+    tests that create their own window run."""
+    yield
+    items = request.session.items
+    last = max(i for i, item in enumerate(items) if item.cls is request.cls)
+    if not any(item.cls is not None and issubclass(item.cls, WindowEventsTestCase)
+               for item in items[last + 1:]):
+        _close_shared_window()
+
+
+_MOD_LABELS = ((key.MOD_SHIFT, '<Shift>'), (key.MOD_ALT, '<Alt/Option>'), (key.MOD_CTRL, '<Ctrl>'))
+
+
 class WindowEventsTestCase(InteractiveTestCase):
     """
     Base class that shows a window displaying instructions for the test. Then it waits for events
@@ -28,6 +78,8 @@ class WindowEventsTestCase(InteractiveTestCase):
         self.finished = False
         self.failure = None
         self.label = None
+        self.batch = None
+        self._dirty = True
 
     def fail_test(self, failure):
         self.failure = failure
@@ -36,33 +88,56 @@ class WindowEventsTestCase(InteractiveTestCase):
     def pass_test(self):
         self.finished = True
 
-    def _render_question(self):
-        fnt = font.load('Courier')
-        self.label = font.Text(fnt, text=self.question, x=10, y=self.window_size[1]-20)
+    def _update_label_text(self):
+        if self.label is not None:
+            self.label.text = self.question
+        self._dirty = True
+
+    def _invalidate(self, *args):
+        self._dirty = True
+
+    def _preload_glyphs(self):
+        """Called with the test window context current, before the question label is created."""
 
     def _draw(self):
-        gl.glClearColor(0.5, 0, 0, 1)
         gl.glClear(gl.GL_COLOR_BUFFER_BIT)
-        gl.glLoadIdentity()
-        self.label.draw()
+        self.batch.draw()
         self.window.flip()
+        self._dirty = False
 
     def _test_main(self):
         assert self.question
 
         width, height = self.window_size
-        self.window = w = Window(width, height, visible=False, resizable=False)
+        self.window = w = _show_shared_window(width, height)
+        w.has_exit = False
         try:
             w.push_handlers(self)
-            self._render_question()
-            w.set_visible()
-
+            w.push_handlers(on_expose=self._invalidate, on_resize=self._invalidate)
+            # Only a single window is used, so bind its context once and not on every draw.
+            w.switch_to()
+            self._preload_glyphs()
+            self.batch = graphics.Batch()
+            self.label = text.Label(self.question, font_name='Courier', x=10, y=height-10,
+                                    anchor_y='top', multiline=True, width=width-20,
+                                    batch=self.batch)
+
+            # The question is static between events, so only redraw when it changed or the
+            # window got exposed. All pending events are dispatched in one go before the next
+            # draw, so a burst of events results in a single redraw.
             while not self.finished and not w.has_exit:
-                self._draw()
+                if self._dirty:
+                    self._draw()
+                app.platform_event_loop.step()
                 w.dispatch_events()
 
         finally:
-            w.close()
+            # Remove the redraw handlers and the test case itself
+            w.pop_handlers()
+            w.pop_handlers()
+            w.set_visible(False)
+            # Hiding queues on_hide/on_deactivate, which must not reach the next test
+            w.dispatch_events()
 
         # TODO: Allow entering reason of failure if user aborts
         self.assertTrue(self.finished, msg="Test aborted")
@@ -75,24 +150,58 @@ class KeyPressWindowEventTestCase(WindowEventsTestCase):
     keys = (key.A, key.B, key.C, key.D, key.E, key.F, key.G, key.H, key.I, key.J, key.K, key.L,
             key.M, key.N, key.O, key.P, key.Q, key.R, key.S, key.T, key.U, key.V, key.W, key.X,
             key.Y, key.Z)
-    mod_shift_keys = (key.LSHIFT, key.RSHIFT)
-    mod_ctrl_keys = (key.LCTRL, key.RCTRL)
-    mod_alt_keys = (key.LALT, key.RALT)
-    mod_option_keys = (key.LOPTION, key.ROPTION)
-    mod_meta_keys = (key.LMETA, key.RMETA)
     mod_meta = key.MOD_SHIFT | key.MOD_ALT
+    _KEY_TO_MOD = {
+        key.LSHIFT: key.MOD_SHIFT, key.RSHIFT: key.MOD_SHIFT,
+        key.LALT: key.MOD_ALT, key.RALT: key.MOD_ALT,
+        key.LCTRL: key.MOD_CTRL, key.RCTRL: key.MOD_CTRL,
+        key.LOPTION: key.MOD_OPTION, key.ROPTION: key.MOD_OPTION,
+        key.LMETA: mod_meta, key.RMETA: mod_meta,
+    }
+    # Keys the meta key can be released as, and vice versa
+    _META_ALIAS = {key.LMETA: key.LALT, key.LALT: key.LMETA, key.RMETA: key.RALT, key.RALT: key.RMETA}
+    # Labels for every combination of the Shift, Alt and Ctrl modifier bits
+    _MODS_CACHE = {bits: ' '.join(label for mod, label in _MOD_LABELS if bits & mod)
+                   for bits in range(8)}
+    question_template = """Please press and release the following combination of keys.
+Only use <Shift> if explicitly asked to do so.
+
+{} {}
+
+
+Press Esc if test does not pass."""
 
     def setUp(self):
         super(KeyPressWindowEventTestCase, self).setUp()
         self.chosen_symbol = None
         self.chosen_modifiers = None
         self.completely_pressed = False
-        self.active_keys = []
+        self.active_keys = set()
         self.checks_passed = 0
+        # Printing from the event handlers slows down dispatching, so only log there
+        self.key_log = collections.deque()
+
+        # Little trick, Ctrl, Alt and Shift are lowest modifier values, so everything between 0 and
+        # the full combination is a permutation of these three.
+        max_modifiers = key.MOD_SHIFT | key.MOD_ALT | key.MOD_CTRL
+        # Give a little more weight to key without modifiers
+        self.sequence = list(zip(random.choices(self.keys, k=self.number_of_checks),
+                                 [max(0, random.randint(-2, max_modifiers))
+                                  for _ in range(self.number_of_checks)]))
+        # Format all questions that can be asked in this run up front
+        self.question_cache = {
+            (symbol, modifiers): self.question_template.format(self._MODS_CACHE[modifiers],
+                                                               key.symbol_string(symbol))
+            for symbol, modifiers in self.sequence}
+
+    def tearDown(self):
+        for action, symbol in self.key_log:
+            print(action, key.symbol_string(symbol))
+        super(KeyPressWindowEventTestCase, self).tearDown()
 
     def on_key_press(self, symbol, modifiers):
-        print('Press: ', key.symbol_string(symbol))
-        self.active_keys.append(symbol)
+        self.key_log.append(('Press: ', symbol))
+        self.active_keys.add(symbol)
 
         if self.completely_pressed:
             self.fail_test('Key already pressed, no release received.')
@@ -107,14 +216,15 @@ class KeyPressWindowEventTestCase(WindowEventsTestCase):
             self.completely_pressed = True
 
     def on_key_release(self, symbol, modifiers):
-        print('Release: ', key.symbol_string(symbol))
+        self.key_log.append(('Release: ', symbol))
         symbol = self._handle_meta_release(symbol)
-        if symbol not in self.active_keys:
+        active_keys = self.active_keys
+        if symbol not in active_keys:
             self.fail_test('Released key "{}" was not pressed before.'.format(key.symbol_string(symbol)))
         else:
-            self.active_keys.remove(symbol)
+            active_keys.remove(symbol)
 
-        if len(self.active_keys) == 0 and self.completely_pressed:
+        if not active_keys and self.completely_pressed:
             self.completely_pressed = False
             self.checks_passed += 1
             if self.checks_passed == self.number_of_checks:
@@ -123,33 +233,12 @@ class KeyPressWindowEventTestCase(WindowEventsTestCase):
                 self._select_next_key()
 
     def _select_next_key(self):
-        self.chosen_symbol = random.choice(self.keys)
-
-        # Little trick, Ctrl, Alt and Shift are lowest modifier values, so everything between 0 and
-        # the full combination is a permutation of these three.
-        max_modifiers = key.MOD_SHIFT | key.MOD_ALT | key.MOD_CTRL
-        # Give a little more weight to key without modifiers
-        self.chosen_modifiers = max(0, random.randint(-2, max_modifiers))
-
+        self.chosen_symbol, self.chosen_modifiers = self.sequence.pop()
         self._update_question()
 
     def _update_question(self):
-        modifiers = []
-        if self.chosen_modifiers & key.MOD_SHIFT:
-            modifiers.append('<Shift>')
-        if self.chosen_modifiers & key.MOD_ALT:
-            modifiers.append('<Alt/Option>')
-        if self.chosen_modifiers & key.MOD_CTRL:
-            modifiers.append('<Ctrl>')
-
-        self.question = """Please press and release the following combination of keys.
-Only use <Shift> if explicitly asked to do so.
-
-{} {}
-
-
-Press Esc if test does not pass.""".format(' '.join(modifiers), key.symbol_string(self.chosen_symbol))
-        self._render_question()
+        self.question = self.question_cache[(self.chosen_symbol, self.chosen_modifiers)]
+        self._update_label_text()
 
     def _is_correct_modifier_key(self, symbol):
         modifier = self._get_modifier_for_key(symbol)
@@ -166,24 +255,12 @@ Press Esc if test does not pass.""".format(' '.join(modifiers), key.symbol_strin
         return True
 
     def _get_modifier_for_key(self, symbol):
-        if symbol in self.mod_shift_keys:
-            return key.MOD_SHIFT
-        elif symbol in self.mod_alt_keys:
-            return key.MOD_ALT
-        elif symbol in self.mod_ctrl_keys:
-            return key.MOD_CTRL
-        elif symbol in self.mod_option_keys:
-            return key.MOD_OPTION
-        elif symbol in self.mod_meta_keys:
-            return self.mod_meta
-        else:
-            return 0
+        return self._KEY_TO_MOD.get(symbol, 0)
 
     def _get_modifiers_from_pressed_keys(self):
-        modifiers = 0
-        for symbol in self.active_keys:
-            modifiers |= self._get_modifier_for_key(symbol)
-        return modifiers
+        return functools.reduce(operator.or_,
+                                (self._KEY_TO_MOD.get(symbol, 0) for symbol in self.active_keys),
+                                0)
 
     def _translate_option_modifier(self, modifiers):
         """
@@ -218,16 +295,9 @@ Press Esc if test does not pass.""".format(' '.join(modifiers), key.symbol_strin
 
     def _handle_meta_release(self, symbol):
         """The meta key can be either released as meta or as alt shift or vv"""
-        if symbol in (key.LMETA, key.LALT, key.RMETA, key.RALT):
-            if symbol not in self.active_keys:
-                if symbol == key.LMETA and key.LALT in self.active_keys:
-                    return key.LALT
-                if symbol == key.RMETA and key.RALT in self.active_keys:
-                    return key.RALT
-                if symbol == key.LALT and key.LMETA in self.active_keys:
-                    return key.LMETA
-                if symbol == key.RALT and key.RMETA in self.active_keys:
-                    return key.RMETA
+        alias = self._META_ALIAS.get(symbol)
+        if alias is not None and symbol not in self.active_keys and alias in self.active_keys:
+            return alias
         return symbol
 
     def test_key_press_release(self):
@@ -240,11 +310,25 @@ Press Esc if test does not pass.""".format(' '.join(modifiers), key.symbol_strin
 class TextWindowEventsTest(WindowEventsTestCase):
     number_of_checks = 10
     text = '`1234567890-=~!@#$%^&*()_+qwertyuiop[]\\QWERTYUIOP{}|asdfghjkl;\'ASDFGHJKL:"zxcvbnm,./ZXCVBNM<>?'
+    question_template = """Please type the followin character exactly.
+Use <Shift> if needed.
+
+{}
+
+
+Press Esc if test does not pass."""
 
     def setUp(self):
         super(TextWindowEventsTest, self).setUp()
         self.chosen_text = None
         self.checks_passed = 0
+        self.sequence = random.choices(self.text, k=self.number_of_checks)
+        self.question_cache = {char: self.question_template.format(char) for char in self.sequence}
+
+    def _preload_glyphs(self):
+        # Rasterize every glyph that can be shown up front, so the font texture is not
+        # updated in the middle of the test.
+        font.load('Courier').get_glyphs(self.text + self.question_template)
 
     def on_text(self, text):
         if text != self.chosen_text:
@@ -257,18 +341,12 @@ class TextWindowEventsTest(WindowEventsTestCase):
                 self._select_next_text()
 
     def _select_next_text(self):
-        self.chosen_text = random.choice(self.text)
+        self.chosen_text = self.sequence.pop()
         self._update_question()
 
     def _update_question(self):
-        self.question = """Please type the followin character exactly.
-Use <Shift> if needed.
-
-{}
-
-
-Press Esc if test does not pass.""".format(self.chosen_text)
-        self._render_question()
+        self.question = self.question_cache[self.chosen_text]
+        self._update_label_text()
 
     def test_key_text(self):
         """Show several keys to press. Check that the text events are triggered correctly."""
@@ -316,7 +394,7 @@ class TextMotionWindowEventsTest(WindowEventsTestCase):
 Press the X key if you do not have this motion key.
 Press Esc if test does not pass.""".format(key.motion_string(self.chosen_key),
                                            key.symbol_string(self.chosen_key))
-        self._render_question()
+        self._update_label_text()
 
     def test_key_text_motion(self):
         """Show several motion keys to press. Check that the on_text_motion events are triggered
@@ -364,7 +442,7 @@ class TextMotionSelectWindowEventsTest(WindowEventsTestCase):
 Press the X key if you do not have this motion key.
 Press Esc if test does not pass.""".format(key.motion_string(self.chosen_key),
                                            key.symbol_string(self.chosen_key))
-        self._render_question()
+        self._update_label_text()
 
     def test_key_text_motion_select(self):
         """Show several motion keys to press. Check that the on_text_motion_select events are
@@ -420,7 +498,7 @@ class ActivateDeactivateWindowEventsTest(WindowEventsTestCase):
             self.question = "Please activate another window."
         else:
             self.question = "Please activate this window."
-        self._render_question()
+        self._update_label_text()
 
     def test_activate_deactivate(self):
         """Test the on_activate and on_deactivate events triggered when the window gets activated